@@ -1,14 +1,24 @@
 import streamlit as st
-from llm_engine import get_ai_response, initialize_llm, regenerate_response
+from llm_engine import get_ai_response, get_ai_response_stream, initialize_llm, regenerate_response, resolve_llm, run_async, trim_history
 from database import Database
 from pdf_generator import generate_user_guide_pdf
 from web_search import search_web
+from ui_templates import EXTRA_CSS, HEADER_HTML_DARK, HEADER_HTML_LIGHT, WELCOME_HTML_DARK, WELCOME_HTML_LIGHT
 from pathlib import Path
-from langchain_core.messages import HumanMessage, AIMessage
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain.memory import ConversationSummaryBufferMemory
 import time
 from datetime import datetime
 import json
 import base64
+import atexit
+import logging
+import uuid
+from collections import deque
+
+# App and library warnings go to stderr rather than through print()
+logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+log = logging.getLogger("contextiq")
 
 # Page config
 st.set_page_config(
@@ -18,10 +28,33 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# Theme stylesheets are read from disk once per file, not on every rerun
+@st.cache_data
+def load_css(path: str) -> str:
+    css_path = Path(path)
+    if not css_path.exists():
+        return ""
+    return f"<style>{css_path.read_text()}</style>"
+
+# Only the most recent messages are kept in the session for display;
+# the full conversation lives in the database
+MAX_DISPLAY_MESSAGES = 200
+
+# Token budget for the conversation memory; older turns are folded into a summary
+MEMORY_TOKEN_LIMIT = 1024
+
+# The user guide is static, so the PDF is generated once per process
+@st.cache_data(show_spinner=False)
+def load_user_guide_pdf() -> bytes:
+    return Path(generate_user_guide_pdf()).read_bytes()
+
 # Initialize database
 @st.cache_resource
 def get_database():
-    return Database()
+    database = Database()
+    # Chat turns are saved with commit=False; write whatever is queued on shutdown
+    atexit.register(database.flush)
+    return database
 
 db = get_database()
 
@@ -31,54 +64,11 @@ if "theme_mode" not in st.session_state:
 
 # Load CSS based on theme
 css_file = "assets/style-dark.css" if st.session_state.theme_mode == "dark" else "assets/style-light.css"
-css_path = Path(css_file)
-if css_path.exists():
-    st.markdown(f"<style>{css_path.read_text()}</style>", unsafe_allow_html=True)
-
-# Additional CSS for new features
-st.markdown("""
-<style>
-.action-button {
-    display: inline-block;
-    padding: 5px 10px;
-    margin: 5px;
-    border-radius: 5px;
-    cursor: pointer;
-    font-size: 12px;
-}
-.copy-btn {
-    background: #4CAF50;
-    color: white;
-}
-.regenerate-btn {
-    background: #2196F3;
-    color: white;
-}
-.export-btn {
-    background: #FF9800;
-    color: white;
-}
-.conversation-item {
-    padding: 10px;
-    margin: 5px 0;
-    border-radius: 8px;
-    cursor: pointer;
-    transition: all 0.3s;
-}
-.conversation-item:hover {
-    background: rgba(102, 126, 234, 0.1);
-}
-.search-badge {
-    display: inline-block;
-    background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-    color: white;
-    padding: 2px 8px;
-    border-radius: 12px;
-    font-size: 10px;
-    margin-left: 5px;
-}
-</style>
-""", unsafe_allow_html=True)
+theme_css = load_css(css_file)
+if theme_css:
+    st.markdown(theme_css, unsafe_allow_html=True)
+
+st.markdown(EXTRA_CSS, unsafe_allow_html=True)
 
 # Sidebar
 with st.sidebar:
@@ -138,6 +128,16 @@ with st.sidebar:
         help="Maximum response length"
     )
     
+    # Context window
+    context_window = st.slider(
+        "🧠 Context Window",
+        min_value=2,
+        max_value=40,
+        value=10,
+        step=2,
+        help="Recent messages sent to the AI. Fewer = faster, more = better recall"
+    )
+    
     # Web search toggle
     enable_web_search = st.checkbox(
         "🔍 Enable Web Search",
@@ -152,6 +152,23 @@ with st.sidebar:
         help="See responses as they're generated"
     )
     
+    # Response cache toggle
+    enable_response_cache = st.checkbox(
+        "⚡ Response Cache",
+        value=False,
+        help="Instantly reuse answers to repeated questions; near-identical ones too with fastembed and faiss-cpu installed. "
+             "Cached answers are shared by everyone using this app"
+    )
+    
+    # Regeneration alternatives
+    regen_alternatives = st.slider(
+        "🔀 Regenerate Alternatives",
+        min_value=1,
+        max_value=4,
+        value=1,
+        help="Responses generated in parallel on regenerate. More than 1 turns off streaming for regenerations"
+    )
+    
     # System prompt
     with st.expander("🎯 System Prompt"):
         custom_system_prompt = st.text_area(
@@ -167,8 +184,12 @@ with st.sidebar:
     
     # New conversation button
     if st.button("➕ New Chat", use_container_width=True):
-        st.session_state.messages = []
-        st.session_state.lc_history = []
+        db.flush()
+        st.session_state.messages = deque(maxlen=MAX_DISPLAY_MESSAGES)
+        st.session_state.user_count = 0
+        st.session_state.bot_count = 0
+        st.session_state.pop("memory", None)
+        st.session_state.pop("conversation_id", None)
         st.session_state.current_conversation_id = None
         st.rerun()
     
@@ -192,16 +213,16 @@ with st.sidebar:
                     key=f"load_{conv['id']}",
                     use_container_width=True
                 ):
-                    # Load conversation
+                    # Load conversation (saving any queued turns first)
+                    db.flush()
                     loaded = db.get_conversation(conv['id'])
                     if loaded:
-                        st.session_state.messages = loaded['messages']
-                        st.session_state.lc_history = []
-                        for msg in loaded['messages']:
-                            if msg['role'] == 'user':
-                                st.session_state.lc_history.append(HumanMessage(content=msg['content']))
-                            else:
-                                st.session_state.lc_history.append(AIMessage(content=msg['content']))
+                        st.session_state.messages = deque(loaded['messages'], maxlen=MAX_DISPLAY_MESSAGES)
+                        st.session_state.user_count = sum(1 for m in loaded['messages'] if m['role'] == 'user')
+                        st.session_state.bot_count = len(loaded['messages']) - st.session_state.user_count
+                        # Memory is rebuilt from the loaded messages after LLM init
+                        st.session_state.pop("memory", None)
+                        st.session_state.pop("conversation_id", None)
                         st.session_state.current_conversation_id = conv['id']
                         st.rerun()
             with col2:
@@ -219,10 +240,11 @@ with st.sidebar:
         with col1:
             if st.button("📄 TXT", use_container_width=True):
                 # Export as text
-                text_content = f"ContextIQ Conversation\nExported: {datetime.now().strftime('%Y-%m-%d %H:%M')}\n\n"
+                parts = [f"ContextIQ Conversation\nExported: {datetime.now().strftime('%Y-%m-%d %H:%M')}\n\n"]
                 for msg in st.session_state.messages:
                     role = "You" if msg['role'] == 'user' else "ContextIQ"
-                    text_content += f"{role}:\n{msg['content']}\n\n"
+                    parts.append(f"{role}:\n{msg['content']}\n\n")
+                text_content = "".join(parts)
                 
                 st.download_button(
                     "💾 Download TXT",
@@ -234,7 +256,7 @@ with st.sidebar:
         with col2:
             if st.button("📑 JSON", use_container_width=True):
                 # Export as JSON
-                json_content = json.dumps(st.session_state.messages, indent=2)
+                json_content = json.dumps(list(st.session_state.messages), indent=2)
                 st.download_button(
                     "💾 Download JSON",
                     json_content,
@@ -247,27 +269,23 @@ with st.sidebar:
     # User Guide button - Generate PDF
     if st.button("📚 Download User Guide (PDF)", use_container_width=True):
         with st.spinner("Generating PDF..."):
-            pdf_path = generate_user_guide_pdf()
-            with open(pdf_path, "rb") as pdf_file:
-                pdf_bytes = pdf_file.read()
-                st.download_button(
-                    label="💾 Download PDF Guide",
-                    data=pdf_bytes,
-                    file_name="ContextIQ_User_Guide.pdf",
-                    mime="application/pdf"
-                )
+            pdf_bytes = load_user_guide_pdf()
+        st.download_button(
+            label="💾 Download PDF Guide",
+            data=pdf_bytes,
+            file_name="ContextIQ_User_Guide.pdf",
+            mime="application/pdf"
+        )
     
     # Stats
     st.divider()
     st.markdown("### 📊 Session Stats")
     if "messages" in st.session_state:
-        user_msgs = len([m for m in st.session_state.messages if m["role"] == "user"])
-        bot_msgs = len([m for m in st.session_state.messages if m["role"] == "assistant"])
-        st.metric("Your Messages", user_msgs)
-        st.metric("AI Responses", bot_msgs)
+        st.metric("Your Messages", st.session_state.user_count)
+        st.metric("AI Responses", st.session_state.bot_count)
         
         # Total conversations in database
-        total_convs = len(db.get_all_conversations())
+        total_convs = db.count_conversations()
         st.metric("Total Conversations", total_convs)
     
     st.divider()
@@ -277,26 +295,19 @@ with st.sidebar:
     st.caption("🚀 Hosted on Streamlit")
 
 # Header
-header_gradient = "linear-gradient(135deg, #667eea 0%, #764ba2 100%)" if st.session_state.theme_mode == "dark" else "linear-gradient(135deg, #6366f1 0%, #8b5cf6 100%)"
-st.markdown(f"""
-<div style='text-align: center; padding: 20px 0;'>
-    <h1 style='background: {header_gradient}; -webkit-background-clip: text; -webkit-text-fill-color: transparent; margin-bottom: 0;'>🤖 ContextIQ</h1>
-    <p style='font-size: 18px; color: #888; margin-top: 5px;'>Your Intelligent AI Assistant with Web Search & Memory</p>
-</div>
-""", unsafe_allow_html=True)
+st.markdown(HEADER_HTML_DARK if st.session_state.theme_mode == "dark" else HEADER_HTML_LIGHT, unsafe_allow_html=True)
 
 # Initialize session state
 if "messages" not in st.session_state:
-    st.session_state.messages = []
-
-if "lc_history" not in st.session_state:
-    st.session_state.lc_history = []
+    st.session_state.messages = deque(maxlen=MAX_DISPLAY_MESSAGES)
 
-if "llm_initialized" not in st.session_state:
-    st.session_state.llm_initialized = False
+# Stable id for the chat session, sent with every request so a conversation's
+# turns are grouped together (e.g. as one LangSmith thread)
+st.session_state.setdefault("conversation_id", uuid.uuid4().hex)
 
-if "current_model" not in st.session_state:
-    st.session_state.current_model = None
+# Message counters for the sidebar stats, kept in step with messages
+st.session_state.setdefault("user_count", 0)
+st.session_state.setdefault("bot_count", 0)
 
 if "current_conversation_id" not in st.session_state:
     st.session_state.current_conversation_id = None
@@ -304,239 +315,345 @@ if "current_conversation_id" not in st.session_state:
 if "regenerate_index" not in st.session_state:
     st.session_state.regenerate_index = None
 
-# Initialize LLM
-if not st.session_state.llm_initialized or st.session_state.current_model != model_option:
-    try:
-        with st.spinner("🔄 Initializing AI model..."):
-            initialize_llm(
-                model=model_option,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                system_prompt=custom_system_prompt,
-                streaming=enable_streaming
-            )
-            st.session_state.llm_initialized = True
-            st.session_state.current_model = model_option
-    except Exception as e:
-        st.error(f"❌ Error: {str(e)}")
-        st.info("💡 Make sure your GROQ_API_KEY is set in .streamlit/secrets.toml")
-        st.code("""
+# Select the LLM (the client is cached per model; sidebar settings are sent per request)
+try:
+    llm = initialize_llm(model=model_option)
+except Exception as e:
+    st.error(f"❌ Error: {str(e)}")
+    st.info("💡 Make sure your GROQ_API_KEY is set in .streamlit/secrets.toml or the environment")
+    st.code("""
 # .streamlit/secrets.toml
 GROQ_API_KEY = "your_api_key_here"
 TAVILY_API_KEY = "your_tavily_key_here"  # Optional, for web search
 LANGSMITH_API_KEY = "your_langsmith_key_here"  # Optional, for tracing
-        """)
-        st.stop()
-
-# Display welcome message or chat history
-if not st.session_state.messages:
-    welcome_bg = "linear-gradient(135deg, #667eea 0%, #764ba2 100%)" if st.session_state.theme_mode == "dark" else "linear-gradient(135deg, #6366f1 0%, #8b5cf6 100%)"
-    st.markdown(f"""
-    <div style='text-align: center; padding: 60px 20px; background: {welcome_bg}; border-radius: 15px; color: white; margin: 20px 0;'>
-        <h2 style='margin-bottom: 20px;'>👋 Welcome to ContextIQ!</h2>
-        <p style='font-size: 18px; margin-bottom: 30px;'>Your powerful AI assistant with advanced features</p>
-        <div style='display: flex; justify-content: center; gap: 30px; flex-wrap: wrap;'>
-            <div style='text-align: center;'>
-                <div style='font-size: 32px; margin-bottom: 10px;'>💻</div>
-                <div>Coding Help</div>
-            </div>
-            <div style='text-align: center;'>
-                <div style='font-size: 32px; margin-bottom: 10px;'>🔍</div>
-                <div>Web Search</div>
-            </div>
-            <div style='text-align: center;'>
-                <div style='font-size: 32px; margin-bottom: 10px;'>💾</div>
-                <div>Save History</div>
-            </div>
-            <div style='text-align: center;'>
-                <div style='font-size: 32px; margin-bottom: 10px;'>💬</div>
-                <div>Streaming</div>
-            </div>
-        </div>
-        <p style='margin-top: 30px; font-size: 14px; opacity: 0.9;'>Download the User Guide PDF from the sidebar!</p>
-    </div>
-    """, unsafe_allow_html=True)
-else:
-    # Display chat messages with action buttons
-    for i, msg in enumerate(st.session_state.messages):
-        if msg["role"] == "user":
-            st.markdown(
-                f"""
-                <div class='chat-bubble-user'>
-                    <strong>You</strong><br/>
-                    {msg['content']}
-                </div>
-                """,
-                unsafe_allow_html=True
-            )
+    """)
+    st.stop()
+
+# Conversation memory: older turns are summarized, recent turns kept verbatim
+if "memory" not in st.session_state:
+    st.session_state.memory = ConversationSummaryBufferMemory(
+        llm=llm,
+        max_token_limit=MEMORY_TOKEN_LIMIT,
+        return_messages=True
+    )
+    # Seed a loaded chat with only its most recent messages that fit the limit;
+    # seeding everything would summarize the whole backlog in one LLM call
+    seeded, tokens = [], 0
+    for msg in reversed(st.session_state.messages):
+        tokens += llm.get_num_tokens(msg['content'])
+        if tokens > MEMORY_TOKEN_LIMIT:
+            break
+        seeded.append(msg)
+    for msg in reversed(seeded):
+        if msg['role'] == 'user':
+            st.session_state.memory.chat_memory.add_user_message(msg['content'])
         else:
-            # Create columns for message and action buttons
-            col1, col2 = st.columns([5, 1])
-            
-            with col1:
-                # Show web search badge if used
-                web_search_badge = ""
-                if msg.get('web_search_used'):
-                    web_search_badge = "<span class='search-badge'>🔍 Web Search</span>"
-                
-                st.markdown(
-                    f"""
-                    <div class='chat-bubble-bot'>
-                        <strong>ContextIQ</strong> {web_search_badge}<br/>
-                        {msg['content']}
-                    </div>
-                    """,
-                    unsafe_allow_html=True
-                )
-            
-            with col2:
-                # Copy button
-                if st.button("📋", key=f"copy_{i}", help="Copy response"):
-                    st.code(msg['content'], language=None)
-                    st.success("✅ Copied!")
-                
-                # Regenerate button (only for last message)
-                if i == len(st.session_state.messages) - 1:
-                    if st.button("🔄", key=f"regen_{i}", help="Regenerate"):
-                        st.session_state.regenerate_index = i
-                        st.rerun()
+            st.session_state.memory.chat_memory.add_ai_message(msg['content'])
+memory = st.session_state.memory
+memory.llm = llm
+
+def remember_turn(user_text, response):
+    """Add an answered turn to the conversation memory"""
+    memory.chat_memory.add_user_message(user_text)
+    memory.chat_memory.add_ai_message(response)
+    
+    # Like memory.prune(), but the turn just answered always stays verbatim, even
+    # if it alone is over the limit, so regenerating it can take it back out
+    older, latest = memory.chat_memory.messages[:-2], memory.chat_memory.messages[-2:]
+    count_tokens = memory.llm.get_num_tokens_from_messages
+    pruned = []
+    while older and count_tokens(older + latest) > memory.max_token_limit:
+        pruned.append(older.pop(0))
+    if not pruned:
+        return
+    # Folding old turns into the summary is an LLM call of its own. If it
+    # fails, keep them verbatim and try again after the next turn.
+    try:
+        memory.moving_summary_buffer = memory.predict_new_summary(pruned, memory.moving_summary_buffer)
+    except Exception as e:
+        log.warning("Conversation summary failed, keeping turns verbatim: %s", e)
+        return
+    memory.chat_memory.messages[:] = older + latest
+
+def save_turn(messages, replace_last=False):
+    """Queue messages for the current conversation, creating it on the first turn.
+    
+    Messages that never reach the database keep an "unsaved" flag, so a
+    regeneration knows whether the stored conversation ends with this turn.
+    """
+    for msg in messages:
+        msg.pop("unsaved", None)
+    try:
+        if st.session_state.current_conversation_id is None:
+            user_input = next(m['content'] for m in messages if m['role'] == 'user')
+            title = user_input[:50] if len(user_input) <= 50 else user_input[:47] + "..."
+            st.session_state.current_conversation_id = db.create_conversation(title, model_option)
+            st.session_state.conversation_created = True
+    except Exception as e:
+        for msg in messages:
+            msg["unsaved"] = True
+        log.warning("Creating the conversation failed: %s", e)
+        st.warning(f"⚠️ This turn could not be saved: {str(e)}")
+        return
+    
+    try:
+        # Display history is capped, so only new messages are written
+        db.append_messages(
+            st.session_state.current_conversation_id,
+            messages,
+            replace_last=replace_last,
+            commit=False
+        )
+    except Exception as e:
+        log.warning("Saving the conversation failed: %s", e)
+        st.warning(f"⚠️ This turn could not be saved: {str(e)}")
+
+def request_regeneration(index):
+    """Button callback: regenerate the response at `index` on this rerun"""
+    st.session_state.regenerate_index = index
 
-# Handle regeneration
-if st.session_state.regenerate_index is not None:
-    idx = st.session_state.regenerate_index
-    if idx > 0:
-        # Get the user message that prompted this response
-        user_msg = st.session_state.messages[idx - 1]['content']
+def message_actions(i, msg, latest):
+    """Copy and regenerate buttons for an AI response; returns the regenerate button's slot"""
+    col1, col2, _ = st.columns([1, 1, 10])
+    with col1:
+        # Copy button
+        copy_clicked = st.button("📋", key=f"copy_{i}", help="Copy response")
+
+    with col2:
+        # Regenerate button (only for the latest response)
+        regen_slot = st.empty()
+        if latest:
+            regen_slot.button("🔄", key=f"regen_{i}", help="Regenerate", on_click=request_regeneration, args=(i,))
+
+    if copy_clicked:
+        st.code(msg['content'], language=None)
+        st.success("✅ Copied!")
+    return regen_slot
+
+# Chat panel runs as a fragment: chat submissions and message actions rerun
+# only this part of the page, not the sidebar and header above it
+@st.fragment
+def chat_panel():
+    # Handle regeneration
+    if st.session_state.regenerate_index is not None:
+        idx = st.session_state.regenerate_index
+        # Only the latest response can be regenerated; ignore stale button clicks
+        if 0 < idx == len(st.session_state.messages) - 1:
+            # Get the user message that prompted this response
+            question = st.session_state.messages[idx - 1]
+            user_msg = question['content']
         
-        # Remove last AI response
-        st.session_state.messages.pop()
-        st.session_state.lc_history.pop()
+            # Remove last AI response; the turn is saved to memory again once regenerated
+            st.session_state.messages.pop()
+            st.session_state.bot_count -= 1
+            chat_memory = memory.chat_memory.messages
+            if chat_memory and isinstance(chat_memory[-1], AIMessage):
+                chat_memory.pop()
+            if chat_memory and isinstance(chat_memory[-1], HumanMessage):
+                chat_memory.pop()
+            history = trim_history(memory.load_memory_variables({})["history"], context_window)
         
-        # Regenerate
-        with st.spinner("🔄 Regenerating response..."):
-            start_time = time.time()
+            # Regenerate (alternatives are requested as one parallel batch, not streamed)
+            stream_regen = enable_streaming and regen_alternatives == 1
+            with st.spinner("🔄 Regenerating response..."):
+                start_time = time.time()
+                alternatives = []
             
-            try:
-                if enable_streaming:
-                    stream_container = st.empty()
-                    response = regenerate_response(
-                        user_msg,
-                        st.session_state.lc_history,
-                        temperature=temperature,
-                        max_tokens=max_tokens,
-                        system_prompt=custom_system_prompt,
-                        streaming=True,
-                        stream_container=stream_container
-                    )
-                else:
-                    response = regenerate_response(
-                        user_msg,
-                        st.session_state.lc_history,
-                        temperature=temperature,
-                        max_tokens=max_tokens,
-                        system_prompt=custom_system_prompt,
-                        streaming=False
-                    )
+                try:
+                    if stream_regen:
+                        stream_container = st.empty()
+                        # Regenerations are never served from the semantic cache
+                        response = stream_container.write_stream(get_ai_response_stream(
+                            user_msg,
+                            history,
+                            temperature=temperature,
+                            max_tokens=max_tokens,
+                            system_prompt=custom_system_prompt,
+                            conversation_id=st.session_state.conversation_id,
+                            model=model_option
+                        ))
+                    else:
+                        response, *alternatives = run_async(regenerate_response(
+                            user_msg,
+                            history,
+                            temperature=temperature,
+                            max_tokens=max_tokens,
+                            system_prompt=custom_system_prompt,
+                            conversation_id=st.session_state.conversation_id,
+                            model=model_option,
+                            n=regen_alternatives
+                        ))
                 
-                response_time = time.time() - start_time
+                except Exception as e:
+                    # Keep the unanswered question in memory, as for a failed turn
+                    memory.chat_memory.add_user_message(user_msg)
+                    error_msg = f"❌ Error regenerating: {str(e)}"
+                    st.session_state.messages.append({
+                        "role": "assistant",
+                        "content": error_msg,
+                        "unsaved": True
+                    })
+                    st.session_state.bot_count += 1
                 
-                # Add new AI response
-                st.session_state.messages.append({
-                    "role": "assistant",
-                    "content": response,
-                    "response_time": response_time,
-                    "regenerated": True
-                })
-                st.session_state.lc_history.append(AIMessage(content=response))
+                else:
+                    # Add new AI response
+                    new_message = {
+                        "role": "assistant",
+                        "content": response,
+                        "response_time": time.time() - start_time,
+                        "regenerated": True
+                    }
+                    if alternatives:
+                        new_message["alternatives"] = alternatives
+                    st.session_state.messages.append(new_message)
+                    st.session_state.bot_count += 1
+                    remember_turn(user_msg, response)
                 
-            except Exception as e:
-                error_msg = f"❌ Error regenerating: {str(e)}"
-                st.session_state.messages.append({
-                    "role": "assistant",
-                    "content": error_msg
-                })
+                    # A stored question is followed by its stored response, which the
+                    # regenerated one replaces; a failed turn was never stored at all
+                    if question.get("unsaved"):
+                        save_turn([question, new_message])
+                    elif st.session_state.current_conversation_id is not None:
+                        save_turn([new_message], replace_last=True)
+            
+            if stream_regen:
+                # The new response is rendered with the history below
+                stream_container.empty()
         
         st.session_state.regenerate_index = None
-        st.rerun()
 
-# Chat input
-user_input = st.chat_input("💬 Ask me anything... (Enable web search for current info!)", key="user_input")
+    # Display welcome message or chat history
+    welcome_placeholder = st.empty()
+    regen_slot = None
+    if not st.session_state.messages:
+        welcome_placeholder.markdown(WELCOME_HTML_DARK if st.session_state.theme_mode == "dark" else WELCOME_HTML_LIGHT, unsafe_allow_html=True)
+    else:
+        # Display chat messages with action buttons
+        for i, msg in enumerate(st.session_state.messages):
+            with st.chat_message(msg["role"]):
+                if msg["role"] == "user":
+                    st.markdown(msg["content"])
+                    continue
+            
+                # Show web search badge if used
+                if msg.get('web_search_used'):
+                    st.caption("🔍 Web Search")
+                st.markdown(msg["content"])
+                
+                # Other responses from a multi-candidate regeneration
+                if msg.get('alternatives'):
+                    with st.expander(f"🔀 {len(msg['alternatives'])} alternative responses"):
+                        for j, alternative in enumerate(msg['alternatives']):
+                            if j:
+                                st.divider()
+                            st.markdown(alternative)
+            
+                regen_slot = message_actions(i, msg, i == len(st.session_state.messages) - 1)
+
+    # Inside a fragment the chat input is drawn inline, not pinned to the bottom,
+    # so the new turn goes in a container placed above it
+    new_turn = st.container()
 
-if user_input:
-    # Add user message
-    st.session_state.messages.append({"role": "user", "content": user_input})
-    st.session_state.lc_history.append(HumanMessage(content=user_input))
+    # Chat input
+    user_input = st.chat_input("💬 Ask me anything... (Enable web search for current info!)", key="user_input")
+
+    if user_input:
+        # Render the new turn in place instead of rerunning the whole script;
+        # the previous response is no longer the latest, so it can't be regenerated
+        welcome_placeholder.empty()
+        if regen_slot is not None:
+            regen_slot.empty()
+        with new_turn.chat_message("user"):
+            st.markdown(user_input)
     
-    # Determine if we should use web search
-    use_web_search = enable_web_search
+        # Add user message
+        user_message = {"role": "user", "content": user_input}
+        st.session_state.messages.append(user_message)
+        st.session_state.user_count += 1
+        # Earlier turns only; this turn is saved to memory once it is answered
+        history = trim_history(memory.load_memory_variables({})["history"], context_window)
     
-    # Generate AI response
-    if enable_streaming:
-        stream_container = st.empty()
-        stream_container.markdown("🧠 Thinking...")
+        # Determine if we should use web search
+        use_web_search = enable_web_search
     
-    with st.spinner("🧠 Processing..."):
+        # Generate AI response
         start_time = time.time()
-        
-        try:
-            # Check if web search should be used
-            if use_web_search:
-                # Use web search
-                from llm_engine import llm
-                response = search_web(user_input, llm)
-                web_search_used = True
-            else:
-                # Regular response
-                if enable_streaming:
-                    response = get_ai_response(
-                        user_input,
-                        st.session_state.lc_history,
-                        temperature=temperature,
-                        max_tokens=max_tokens,
-                        system_prompt=custom_system_prompt,
-                        streaming=True,
-                        stream_container=stream_container
-                    )
+    
+        with new_turn.chat_message("assistant"):
+            try:
+                # Check if web search should be used
+                if use_web_search:
+                    # Use web search
+                    with st.spinner("🔍 Searching the web..."):
+                        # The shared client has no sampling settings; send the sidebar's
+                        response = search_web(user_input, resolve_llm(model_option, temperature, max_tokens))
+                    st.caption("🔍 Web Search")
+                    st.markdown(response)
+                    web_search_used = True
                 else:
-                    response = get_ai_response(
-                        user_input,
-                        st.session_state.lc_history,
-                        temperature=temperature,
-                        max_tokens=max_tokens,
-                        system_prompt=custom_system_prompt,
-                        streaming=False
-                    )
-                web_search_used = False
-            
-            response_time = time.time() - start_time
+                    # Regular response
+                    if enable_streaming:
+                        # Render tokens as they arrive instead of waiting for the full answer
+                        response = st.write_stream(get_ai_response_stream(
+                            user_input,
+                            history,
+                            temperature=temperature,
+                            max_tokens=max_tokens,
+                            system_prompt=custom_system_prompt,
+                            conversation_id=st.session_state.conversation_id,
+                            use_cache=enable_response_cache,
+                            model=model_option
+                        ))
+                    else:
+                        with st.spinner("🧠 Processing..."):
+                            response = run_async(get_ai_response(
+                                user_input,
+                                history,
+                                temperature=temperature,
+                                max_tokens=max_tokens,
+                                system_prompt=custom_system_prompt,
+                                conversation_id=st.session_state.conversation_id,
+                                use_cache=enable_response_cache,
+                                model=model_option
+                            ))
+                        st.markdown(response)
+                    web_search_used = False
             
-            # Add AI response
-            st.session_state.messages.append({
-                "role": "assistant",
-                "content": response,
-                "response_time": response_time,
-                "web_search_used": web_search_used
-            })
-            st.session_state.lc_history.append(AIMessage(content=response))
-            
-            # Auto-save conversation
-            if st.session_state.current_conversation_id is None:
-                # Create new conversation
-                title = user_input[:50] if len(user_input) <= 50 else user_input[:47] + "..."
-                conv_id = db.create_conversation(title, model_option)
-                st.session_state.current_conversation_id = conv_id
+            except Exception as e:
+                # Keep the unanswered question in memory for context and regeneration
+                memory.chat_memory.add_user_message(user_input)
+                error_msg = f"❌ Error: {str(e)}\n\nPlease try again."
+                st.markdown(error_msg)
+                # Failed turns are not saved; regenerating saves the question with its answer
+                user_message["unsaved"] = True
+                st.session_state.messages.append({
+                    "role": "assistant",
+                    "content": error_msg,
+                    "unsaved": True
+                })
+                st.session_state.bot_count += 1
             
-            # Update conversation
-            db.update_conversation(
-                st.session_state.current_conversation_id,
-                st.session_state.messages
-            )
+            else:
+                # Add AI response
+                ai_message = {
+                    "role": "assistant",
+                    "content": response,
+                    "response_time": time.time() - start_time,
+                    "web_search_used": web_search_used
+                }
+                st.session_state.messages.append(ai_message)
+                st.session_state.bot_count += 1
+                # Memory and the database are updated independently: a failed
+                # summary or save must not turn an answered turn into an error
+                remember_turn(user_input, response)
+                save_turn([user_message, ai_message])
             
-        except Exception as e:
-            error_msg = f"❌ Error: {str(e)}\n\nPlease try again."
-            st.session_state.messages.append({
-                "role": "assistant",
-                "content": error_msg
-            })
-    
-    st.rerun()
+            message_actions(len(st.session_state.messages) - 1, st.session_state.messages[-1], latest=True)
+
+    # The sidebar is outside the fragment, so its Session Stats only refresh on the
+    # next full rerun. A new conversation gets one right away, though: otherwise it
+    # would be missing from Recent Chats and Export until a sidebar widget is touched.
+    if st.session_state.pop("conversation_created", False):
+        st.rerun()
+
+chat_panel()
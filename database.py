@@ -1,11 +1,18 @@
 """
 Database module for storing conversation history
 """
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, Float
+from sqlalchemy import (
+    create_engine, event, Column, Integer, String, Text, DateTime, Float, ForeignKey, Index, select, text, column
+)
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime
-import json
+import logging
+import threading
+import orjson
+
+log = logging.getLogger(__name__)
 
 Base = declarative_base()
 
@@ -17,87 +24,316 @@ class Conversation(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     model = Column(String(100))
-    messages_json = Column(Text)  # Store messages as JSON
+    messages_json = Column(Text)  # Legacy JSON blob; migrated into the messages table on startup
     message_count = Column(Integer, default=0)
 
+class Message(Base):
+    __tablename__ = 'messages'
+    __table_args__ = (Index('ix_messages_conv_seq', 'conv_id', 'seq', unique=True),)
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    conv_id = Column(Integer, ForeignKey('conversations.id'), nullable=False)
+    seq = Column(Integer, nullable=False)  # Position within the conversation
+    role = Column(String(20))
+    content = Column(Text)
+    extra_json = Column(Text)  # Other message fields (response_time, web_search_used, ...)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    @classmethod
+    def from_dict(cls, conv_id, seq, message):
+        """Row for a chat message dict"""
+        extra = {k: v for k, v in message.items() if k not in ("role", "content")}
+        return cls(
+            conv_id=conv_id,
+            seq=seq,
+            role=message.get("role"),
+            content=message.get("content"),
+            extra_json=orjson.dumps(extra).decode() if extra else None
+        )
+    
+    def to_dict(self):
+        """Chat message dict, as the app stores it in session state"""
+        message = {"role": self.role, "content": self.content}
+        if self.extra_json:
+            message.update(orjson.loads(self.extra_json))
+        return message
+
+# SQLite FTS5 indexes over conversation titles and message content, kept in sync by triggers
+FTS_SCHEMA = {
+    "conversations_fts": [
+        """CREATE VIRTUAL TABLE conversations_fts USING fts5(
+            title, content='conversations', content_rowid='id'
+        )""",
+        """CREATE TRIGGER conversations_fts_insert AFTER INSERT ON conversations BEGIN
+            INSERT INTO conversations_fts(rowid, title) VALUES (new.id, new.title);
+        END""",
+        """CREATE TRIGGER conversations_fts_delete AFTER DELETE ON conversations BEGIN
+            INSERT INTO conversations_fts(conversations_fts, rowid, title)
+            VALUES ('delete', old.id, old.title);
+        END""",
+        """CREATE TRIGGER conversations_fts_update AFTER UPDATE OF title ON conversations BEGIN
+            INSERT INTO conversations_fts(conversations_fts, rowid, title)
+            VALUES ('delete', old.id, old.title);
+            INSERT INTO conversations_fts(rowid, title) VALUES (new.id, new.title);
+        END""",
+        # Index conversations saved before the FTS table existed
+        "INSERT INTO conversations_fts(conversations_fts) VALUES ('rebuild')",
+    ],
+    "messages_fts": [
+        """CREATE VIRTUAL TABLE messages_fts USING fts5(
+            content, content='messages', content_rowid='id'
+        )""",
+        """CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+        END""",
+        """CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, content)
+            VALUES ('delete', old.id, old.content);
+        END""",
+        """CREATE TRIGGER messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, content)
+            VALUES ('delete', old.id, old.content);
+            INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+        END""",
+        "INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')",
+    ],
+}
+
+def fts_query(query):
+    """Quote each search term for FTS5 and allow prefix matches"""
+    return " ".join('"' + term.replace('"', '""') + '"*' for term in query.split())
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL lets readers and the writer work concurrently; NORMAL sync is safe under WAL"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
 class Database:
-    def __init__(self, db_path="conversations.db"):
-        self.engine = create_engine(f'sqlite:///{db_path}')
+    def __init__(self, db_path="conversations.db", max_pending=20):
+        # One Database is shared by every Streamlit session/thread, so each
+        # call opens its own short-lived session instead of sharing one
+        self.engine = create_engine(
+            f'sqlite:///{db_path}',
+            connect_args={"check_same_thread": False}
+        )
+        event.listen(self.engine, "connect", _set_sqlite_pragmas)
         Base.metadata.create_all(self.engine)
-        Session = sessionmaker(bind=self.engine)
-        self.session = Session()
+        self.Session = sessionmaker(bind=self.engine)
+        self._migrate_messages_json()
+        self.fts_enabled = self._init_search_index()
+        
+        # Message writes queued with commit=False, per conversation, until flush()
+        self.max_pending = max_pending
+        self._pending = {}
+        self._pending_count = 0
+        self._lock = threading.Lock()
+    
+    def _migrate_messages_json(self):
+        """Move messages from the old per-conversation JSON blob into the messages table"""
+        with self.Session() as session:
+            legacy = session.query(Conversation.id, Conversation.messages_json).filter(
+                Conversation.messages_json.isnot(None)
+            ).all()
+            for conv_id, messages_json in legacy:
+                stored = orjson.loads(messages_json)
+                session.add_all(Message.from_dict(conv_id, seq, m) for seq, m in enumerate(stored))
+                # Keep updated_at as is, so migrated chats keep their place in the list
+                session.query(Conversation).filter_by(id=conv_id).update({
+                    Conversation.messages_json: None,
+                    Conversation.message_count: len(stored),
+                    Conversation.updated_at: Conversation.updated_at
+                }, synchronize_session=False)
+            session.commit()
+    
+    def _init_search_index(self):
+        """Create the FTS5 search indexes if needed; False if SQLite lacks FTS5"""
+        try:
+            with self.engine.begin() as conn:
+                for table, statements in FTS_SCHEMA.items():
+                    exists = conn.execute(text(
+                        "SELECT 1 FROM sqlite_master WHERE type='table' AND name=:name"
+                    ), {"name": table}).first()
+                    if not exists:
+                        for statement in statements:
+                            conn.execute(text(statement))
+            return True
+        except OperationalError as e:
+            log.warning("Full-text search unavailable, falling back to LIKE: %s", e)
+            return False
     
     def create_conversation(self, title, model):
         """Create a new conversation"""
         conv = Conversation(
             title=title,
             model=model,
-            messages_json=json.dumps([]),
             message_count=0
         )
-        self.session.add(conv)
-        self.session.commit()
-        return conv.id
+        with self.Session() as session:
+            session.add(conv)
+            # The id comes from SQLite's autoincrement on flush; read it before
+            # commit expires the object, so no extra SELECT is needed
+            session.flush()
+            conv_id = conv.id
+            session.commit()
+        return conv_id
     
-    def update_conversation(self, conv_id, messages):
+    def update_conversation(self, conv_id, messages, commit=True):
         """Update conversation with new messages"""
-        conv = self.session.query(Conversation).filter_by(id=conv_id).first()
-        if conv:
-            conv.messages_json = json.dumps(messages)
-            conv.message_count = len(messages)
-            conv.updated_at = datetime.utcnow()
-            self.session.commit()
-            return True
-        return False
+        queued = self._queue(conv_id, messages, "set")
+        return self.flush(conv_id) if commit else queued
+    
+    def append_messages(self, conv_id, messages, replace_last=False, commit=True):
+        """Append new messages to a conversation, optionally replacing the last stored one.
+        
+        With commit=False the write is queued until flush(), so a chat does not
+        commit (and fsync) on every turn.
+        """
+        queued = self._queue(conv_id, messages, "replace_last" if replace_last else "append")
+        return self.flush(conv_id) if commit else queued
+    
+    def _queue(self, conv_id, messages, mode):
+        """Queue a message write; flushes everything once max_pending writes are waiting"""
+        with self._lock:
+            if mode == "set":
+                # Writes still queued for this conversation are superseded by the full list
+                self._pending_count -= len(self._pending.pop(conv_id, []))
+            self._pending.setdefault(conv_id, []).append((list(messages), mode))
+            self._pending_count += 1
+            due = self._pending_count >= self.max_pending
+        if due:
+            return self.flush()
+        return True
+    
+    def flush(self, conv_id=None):
+        """Write queued messages in a single transaction (all conversations, or just conv_id).
+        
+        If the transaction fails (e.g. the database is locked or the disk is full)
+        the writes stay queued for the next flush and False is returned.
+        """
+        with self._lock:
+            if conv_id is None:
+                pending = self._pending
+            else:
+                pending = {conv_id: self._pending[conv_id]} if conv_id in self._pending else {}
+            if not pending:
+                return True
+            
+            try:
+                with self.Session() as session:
+                    written = [self._apply(session, cid, ops) for cid, ops in pending.items()]
+                    session.commit()
+            except SQLAlchemyError as e:
+                log.warning("Saving queued messages failed, will retry: %s", e)
+                return False
+            
+            # Dequeued only once committed
+            for cid in list(pending):
+                self._pending_count -= len(self._pending.pop(cid))
+        return all(written)
+    
+    def _apply(self, session, conv_id, ops):
+        """Apply queued writes to one conversation: INSERTs for new messages only"""
+        conv = session.get(Conversation, conv_id)
+        if not conv:
+            return False
+        count = conv.message_count or 0
+        for messages, mode in ops:
+            if mode == "set":
+                session.query(Message).filter_by(conv_id=conv_id).delete(synchronize_session=False)
+                count = 0
+            elif mode == "replace_last" and count:
+                count -= 1
+                session.query(Message).filter_by(conv_id=conv_id, seq=count).delete(synchronize_session=False)
+            session.add_all(Message.from_dict(conv_id, count + i, m) for i, m in enumerate(messages))
+            count += len(messages)
+        conv.message_count = count
+        conv.updated_at = datetime.utcnow()
+        return True
     
     def get_conversation(self, conv_id):
         """Get a specific conversation"""
-        conv = self.session.query(Conversation).filter_by(id=conv_id).first()
-        if conv:
-            return {
-                'id': conv.id,
-                'title': conv.title,
-                'created_at': conv.created_at,
-                'updated_at': conv.updated_at,
-                'model': conv.model,
-                'messages': json.loads(conv.messages_json),
-                'message_count': conv.message_count
-            }
-        return None
+        self.flush(conv_id)
+        with self.Session() as session:
+            conv = session.query(Conversation).filter_by(id=conv_id).first()
+            if conv:
+                messages = session.query(Message).filter_by(conv_id=conv_id).order_by(Message.seq).all()
+                return {
+                    'id': conv.id,
+                    'title': conv.title,
+                    'created_at': conv.created_at,
+                    'updated_at': conv.updated_at,
+                    'model': conv.model,
+                    'messages': [m.to_dict() for m in messages],
+                    'message_count': conv.message_count
+                }
+            return None
+    
+    def _list_conversations(self, *conditions):
+        """Conversation summaries, most recent first"""
+        # Select only light columns: no messages, and no per-row datetime
+        # parsing (ordering happens in SQL). get_conversation has full details.
+        with self.Session() as session:
+            rows = session.query(
+                Conversation.id,
+                Conversation.title,
+                Conversation.model,
+                Conversation.message_count
+            ).filter(*conditions).order_by(Conversation.updated_at.desc()).all()
+        return [{
+            'id': r.id,
+            'title': r.title,
+            'model': r.model,
+            'message_count': r.message_count
+        } for r in rows]
     
     def get_all_conversations(self):
         """Get all conversations, sorted by most recent"""
-        convs = self.session.query(Conversation).order_by(Conversation.updated_at.desc()).all()
-        return [{
-            'id': c.id,
-            'title': c.title,
-            'created_at': c.created_at,
-            'updated_at': c.updated_at,
-            'model': c.model,
-            'message_count': c.message_count
-        } for c in convs]
+        return self._list_conversations()
+    
+    def count_conversations(self):
+        """Number of stored conversations"""
+        with self.Session() as session:
+            return session.query(Conversation.id).count()
     
     def delete_conversation(self, conv_id):
         """Delete a conversation"""
-        conv = self.session.query(Conversation).filter_by(id=conv_id).first()
-        if conv:
-            self.session.delete(conv)
-            self.session.commit()
-            return True
-        return False
+        with self._lock:
+            self._pending_count -= len(self._pending.pop(conv_id, []))
+        with self.Session() as session:
+            conv = session.query(Conversation).filter_by(id=conv_id).first()
+            if conv:
+                session.query(Message).filter_by(conv_id=conv_id).delete(synchronize_session=False)
+                session.delete(conv)
+                session.commit()
+                return True
+            return False
     
     def search_conversations(self, query):
         """Search conversations by title or content"""
-        convs = self.session.query(Conversation).filter(
-            (Conversation.title.contains(query)) | 
-            (Conversation.messages_json.contains(query))
-        ).order_by(Conversation.updated_at.desc()).all()
+        if not query.strip():
+            return self.get_all_conversations()
         
-        return [{
-            'id': c.id,
-            'title': c.title,
-            'created_at': c.created_at,
-            'updated_at': c.updated_at,
-            'model': c.model,
-            'message_count': c.message_count
-        } for c in convs]
+        # Queued messages must be on disk to be searchable
+        self.flush()
+        
+        if self.fts_enabled:
+            q = fts_query(query)
+            title_matches = text(
+                "SELECT rowid FROM conversations_fts WHERE conversations_fts MATCH :q"
+            ).bindparams(q=q).columns(column("rowid", Integer))
+            message_matches = text(
+                "SELECT m.conv_id FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+                "WHERE messages_fts MATCH :q"
+            ).bindparams(q=q).columns(column("conv_id", Integer))
+            condition = Conversation.id.in_(title_matches) | Conversation.id.in_(message_matches)
+        else:
+            condition = (
+                (Conversation.title.contains(query)) | 
+                (Conversation.id.in_(
+                    select(Message.conv_id).where(Message.content.contains(query))
+                ))
+            )
+        
+        return self._list_conversations(condition)
@@ -1,15 +1,38 @@
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_groq import ChatGroq
-from langchain_core.messages import HumanMessage, AIMessage
-from langchain.callbacks.base import BaseCallbackHandler
+from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 import streamlit as st
+from collections import OrderedDict
+from functools import lru_cache
+import asyncio
+import httpx
+import hashlib
+import logging
+import re
+import threading
+import time
+import orjson
 import os
 
+log = logging.getLogger(__name__)
+
+def read_secret(name: str):
+    """A Streamlit secret, falling back to the environment, or None.
+
+    Safe before st.set_page_config: with no secrets.toml, indexing st.secrets
+    renders an st.error, which would count as the page's first command.
+    """
+    try:
+        if st.secrets.load_if_toml_exists() and name in st.secrets:
+            return st.secrets[name]
+    except Exception as e:
+        log.warning("Could not read Streamlit secrets: %s", e)
+    return os.environ.get(name) or None
+
 # LangSmith tracing setup
 def setup_langsmith_tracing():
     """Setup LangSmith tracing if API key is available"""
     try:
-        langsmith_key = st.secrets.get("LANGSMITH_API_KEY", "")
+        langsmith_key = read_secret("LANGSMITH_API_KEY")
         if langsmith_key:
             os.environ["LANGCHAIN_TRACING_V2"] = "true"
             os.environ["LANGCHAIN_ENDPOINT"] = "https://api.smith.langchain.com"
@@ -18,186 +41,557 @@ def setup_langsmith_tracing():
             return True
         return False
     except Exception as e:
-        print(f"LangSmith setup error: {e}")
+        log.warning("LangSmith setup failed: %s", e)
         return False
 
-# Streaming callback handler
-class StreamHandler(BaseCallbackHandler):
-    def __init__(self, container):
-        self.container = container
-        self.text = ""
-    
-    def on_llm_new_token(self, token: str, **kwargs) -> None:
-        self.text += token
-        self.container.markdown(self.text + "▌")
-    
-    def on_llm_end(self, *args, **kwargs) -> None:
-        self.container.markdown(self.text)
+# Tracing is process-wide configuration, so it is set up once at import
+if not os.environ.get("LANGCHAIN_TRACING_V2"):
+    setup_langsmith_tracing()
+
+def read_api_key():
+    """GROQ_API_KEY from Streamlit secrets or the environment, or None if it is not configured"""
+    return read_secret("GROQ_API_KEY")
+
+# Read once at import; only re-checked while the key is still missing
+_API_KEY = read_api_key()
+
+def require_api_key():
+    """The Groq API key; raises ValueError if it is not configured"""
+    global _API_KEY
+    if not _API_KEY:
+        _API_KEY = read_api_key()
+        if not _API_KEY:
+            raise ValueError(
+                "GROQ_API_KEY not found in Streamlit secrets or the environment. "
+                "Please add it in your Streamlit Cloud dashboard or .streamlit/secrets.toml"
+            )
+    return _API_KEY
+
+# Rough token estimate (~4 characters per token) used for memory pruning,
+# so counting history does not require downloading a GPT-2 tokenizer
+def estimate_token_ids(text: str) -> list:
+    return list(range(len(text) // 4 + 1))
 
 # Global LLM instance
 llm = None
-current_config = {}
+current_model = None
 
-def initialize_llm(
-    model: str = "llama-3.3-70b-versatile",
-    temperature: float = 0.3,
-    max_tokens: int = 2048,
-    system_prompt: str = None,
-    streaming: bool = True
-):
-    """Initialize the Groq LLM with specified parameters"""
-    global llm, current_config
+# Request defaults when the caller does not pass its own settings
+DEFAULT_TEMPERATURE = 0.3
+DEFAULT_MAX_TOKENS = 2048
+
+# Models offered in the sidebar; others are passed through with a warning
+_KNOWN_MODELS = frozenset({
+    "llama-3.3-70b-versatile",
+    "llama-3.1-70b-versatile",
+    "mixtral-8x7b-32768",
+    "gemma2-9b-it",
+})
+
+# One connection pool for every model's client, so switching models or
+# sessions reuses open TLS connections to Groq instead of handshaking again
+_HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20)
+_HTTP_CLIENT = httpx.Client(limits=_HTTP_LIMITS)
+_ASYNC_HTTP_CLIENT = httpx.AsyncClient(limits=_HTTP_LIMITS)
+
+# An async HTTP pool must stay on one event loop, so all async LLM calls, from
+# every session, run on this background loop (see run_async)
+_EVENT_LOOP = asyncio.new_event_loop()
+threading.Thread(target=_EVENT_LOOP.run_forever, name="llm-event-loop", daemon=True).start()
+
+def run_async(coro):
+    """Run an LLM coroutine on the shared event loop and wait for its result"""
+    return asyncio.run_coroutine_threadsafe(coro, _EVENT_LOOP).result()
+
+@st.cache_resource(show_spinner=False)
+def get_llm_client(model: str):
+    """Build the Groq client once per model and share it across reruns and sessions.
+
+    Temperature, max tokens, the system prompt and streaming are not baked
+    in here; they are chosen per request instead.
+    """
+    api_key = require_api_key()
     
-    # Setup LangSmith tracing
-    setup_langsmith_tracing()
+    if model not in _KNOWN_MODELS:
+        log.warning("Unknown Groq model '%s', passing it through to the API", model)
     
-    # Get API key from Streamlit secrets
-    try:
-        api_key = st.secrets["GROQ_API_KEY"]
-    except:
-        raise ValueError(
-            "GROQ_API_KEY not found in Streamlit secrets. "
-            "Please add it in your Streamlit Cloud dashboard or .streamlit/secrets.toml"
-        )
+    return ChatGroq(
+        model=model,
+        groq_api_key=api_key,
+        max_retries=3,
+        request_timeout=60,
+        custom_get_token_ids=estimate_token_ids,
+        http_client=_HTTP_CLIENT,
+        http_async_client=_ASYNC_HTTP_CLIENT,
+    )
+
+def initialize_llm(model: str = "llama-3.3-70b-versatile"):
+    """Select the Groq LLM for a model and return its client"""
+    global llm, current_model
+    
+    # Fail fast on a missing key, before touching the client cache
+    require_api_key()
     
     try:
-        # Initialize Groq LLM with proper model names
-        # Map old model names to new ones if needed
-        model_mapping = {
-            "llama-3.3-70b-versatile": "llama-3.3-70b-versatile",
-            "llama-3.1-70b-versatile": "llama-3.1-70b-versatile",
-            "mixtral-8x7b-32768": "mixtral-8x7b-32768",
-            "gemma2-9b-it": "gemma2-9b-it"
-        }
-        
-        actual_model = model_mapping.get(model, model)
+        llm = get_llm_client(model)
+        current_model = model
+        return llm
         
-        llm = ChatGroq(
-            model=actual_model,
-            temperature=temperature,
-            max_tokens=max_tokens,
-            groq_api_key=api_key,
-            streaming=streaming,
-            max_retries=3,
-            request_timeout=60,
-        )
-        
-        current_config = {
-            "model": model,
-            "temperature": temperature,
-            "max_tokens": max_tokens,
-            "system_prompt": system_prompt,
-            "streaming": streaming
-        }
+    except ValueError:
+        raise
+    except Exception as e:
+        raise Exception(f"Failed to initialize LLM: {str(e)}")
+
+DEFAULT_SYSTEM_PROMPT = (
+    "You are ContextIQ, an intelligent, professional, and helpful AI assistant. "
+    "Answer clearly, concisely, and accurately. Provide detailed explanations when needed. "
+    "Use proper formatting with markdown when appropriate. "
+    "If you are unsure about something, honestly say you do not know."
+)
+
+# Messages are immutable once built, so one per system prompt is shared by every call
+@lru_cache(maxsize=32)
+def get_system_message(system_prompt: str = None) -> SystemMessage:
+    """System message for a custom system prompt, or the default one"""
+    return SystemMessage(content=system_prompt or DEFAULT_SYSTEM_PROMPT)
+
+def split_summary(chat_history: list) -> tuple:
+    """Split memory history into (running summary messages, conversation turns)"""
+    n = 0
+    while n < len(chat_history) and isinstance(chat_history[n], SystemMessage):
+        n += 1
+    if n == 0:
+        return [], chat_history  # Common case: no summary yet, no copy
+    return chat_history[:n], chat_history[n:]
+
+def memory_version(chat_history: list) -> str:
+    """Hash of the history's start: the running summary and the oldest kept turn.
+    
+    Between requests with the same version the history was only appended to,
+    so the earlier prompt prefix can be reused.
+    """
+    summary, turns = split_summary(chat_history)
+    if not summary and not turns:
+        return None
+    head = [m.content for m in summary] + [turns[0].content if turns else ""]
+    return hashlib.md5("\n".join(head).encode()).hexdigest()
+
+def trim_history(chat_history: list, window: int) -> list:
+    """Keep the running summary plus at most the last `window` messages.
+    
+    Old messages are dropped in whole blocks of about half a window, not one
+    turn at a time, so the kept history (and the prompt prefix built from it)
+    only changes every few turns, or when the memory is summarized.
+    """
+    summary, turns = split_summary(chat_history)
+    excess = len(turns) - window
+    if excess <= 0:
+        return chat_history
+    step = max(2, window // 4 * 2)  # Even, so the history still starts at a user message
+    drop = -(-excess // step) * step
+    return summary + turns[drop:]
+
+def request_params(temperature: float = None, max_tokens: int = None) -> dict:
+    """Per-request sampling settings, falling back to the defaults"""
+    return {
+        "temperature": DEFAULT_TEMPERATURE if temperature is None else temperature,
+        "max_tokens": DEFAULT_MAX_TOKENS if max_tokens is None else max_tokens,
+    }
+
+@lru_cache(maxsize=16)
+def get_bound_llm(model: str, temperature: float, max_tokens: int):
+    """Client for a model with its sampling settings bound, one per combination.
+    
+    Requests never change shared client state, so concurrent sessions using
+    different models or settings cannot interfere with each other.
+    """
+    return get_llm_client(model).bind(temperature=temperature, max_tokens=max_tokens)
+
+def resolve_llm(model: str = None, temperature: float = None, max_tokens: int = None):
+    """Bound client for a request; model defaults to the one last initialized"""
+    model = model or current_model
+    if model is None:
+        raise RuntimeError("LLM not initialized. Please restart the app.")
+    params = request_params(temperature, max_tokens)
+    return get_bound_llm(model, params["temperature"], params["max_tokens"])
+
+def run_config(conversation_id: str = None, version: str = None) -> dict:
+    """Runnable config tagging the request with its conversation (LangSmith threads)"""
+    metadata = {"conversation_id": conversation_id, "memory_version": version}
+    metadata = {k: v for k, v in metadata.items() if v}
+    return {"metadata": metadata} if metadata else {}
+
+# Optional semantic response cache: answers to earlier, similar prompts are
+# returned without calling the LLM (requires fastembed and faiss-cpu)
+SEMANTIC_CACHE_PATH = "semantic_cache.jsonl"
+SEMANTIC_CACHE_THRESHOLD = 0.9
+SEMANTIC_CACHE_MAX_ENTRIES = 5000  # ~8KB each on disk; the oldest half is dropped past this
+
+class SemanticCache:
+    """Earlier responses, looked up by cosine similarity of the prompt embedding"""
+    
+    def __init__(self, path: str = SEMANTIC_CACHE_PATH, threshold: float = SEMANTIC_CACHE_THRESHOLD,
+                 max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES):
+        import faiss
+        import numpy as np
+        from fastembed import TextEmbedding
         
-        return True
+        self.np = np
+        self.model = TextEmbedding("BAAI/bge-small-en-v1.5")
+        self.index = faiss.IndexFlatIP(384)  # Inner product of unit vectors = cosine
+        self.entries = []
+        self.path = path
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
         
+        # Entries are persisted one JSON line each, so saving a response never rewrites the file
+        if os.path.exists(path):
+            vectors, corrupt = [], False
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        entry = orjson.loads(line)
+                        vectors.append(entry.pop("vector"))
+                    except (orjson.JSONDecodeError, KeyError, AttributeError, TypeError):
+                        # A torn last line from a crash mid-append; the rest is intact
+                        log.warning("Skipping a corrupt line in %s", path)
+                        corrupt = True
+                        continue
+                    self.entries.append(entry)
+            if vectors:
+                self.index.add(np.asarray(vectors, dtype="float32"))
+            if len(self.entries) > max_entries:
+                self._compact()
+            elif corrupt:
+                # Rewritten so the next append doesn't continue a torn line
+                self._rewrite(self.index.reconstruct_n(0, len(self.entries)))
+    
+    def embed(self, text: str):
+        vector = self.np.asarray(next(iter(self.model.embed([text]))), dtype="float32")
+        return vector / (self.np.linalg.norm(vector) or 1.0)
+    
+    def lookup(self, vector, scope: str):
+        """Cached response for the most similar prompt in the same scope, or None"""
+        with self.lock:
+            if not self.entries:
+                return None
+            scores, ids = self.index.search(vector[None, :], min(4, len(self.entries)))
+            for score, i in zip(scores[0], ids[0]):
+                if score < self.threshold:
+                    break
+                if self.entries[i]["scope"] == scope:
+                    return self.entries[i]["response"]
+        return None
+    
+    def add(self, vector, scope: str, response: str):
+        entry = {"scope": scope, "response": response}
+        with self.lock:
+            self.index.add(vector[None, :])
+            self.entries.append(entry)
+            with open(self.path, "ab") as f:
+                f.write(orjson.dumps({**entry, "vector": vector.tolist()}) + b"\n")
+            if len(self.entries) > self.max_entries:
+                self._compact()
+    
+    def _compact(self):
+        """Keep the newest half of the entries, in memory and on disk"""
+        keep = self.max_entries // 2
+        vectors = self.index.reconstruct_n(len(self.entries) - keep, keep)
+        self.entries = self.entries[-keep:]
+        self.index.reset()
+        self.index.add(vectors)
+        self._rewrite(vectors)
+    
+    def _rewrite(self, vectors):
+        """Replace the file with the current entries"""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            for entry, vector in zip(self.entries, vectors):
+                f.write(orjson.dumps({**entry, "vector": vector.tolist()}) + b"\n")
+        os.replace(tmp_path, self.path)
+
+@st.cache_resource(show_spinner=False)
+def get_semantic_cache():
+    """Shared semantic cache, or None if its optional dependencies are missing"""
+    try:
+        return SemanticCache()
+    except ImportError as e:
+        log.warning("Semantic cache unavailable (pip install fastembed faiss-cpu): %s", e)
     except Exception as e:
-        raise Exception(f"Failed to initialize LLM: {str(e)}")
+        # Cached as None too: retrying a failing model load on every request would be slow
+        log.warning("Semantic cache failed to load: %s", e)
+    return None
 
-def get_prompt_template(system_prompt: str = None):
-    """Create prompt template with optional custom system prompt"""
-    default_prompt = (
-        "You are ContextIQ, an intelligent, professional, and helpful AI assistant. "
-        "Answer clearly, concisely, and accurately. Provide detailed explanations when needed. "
-        "Use proper formatting with markdown when appropriate. "
-        "If you are unsure about something, honestly say you do not know."
+# Exact repeats ("thanks", "continue") of a turn in the same conversation state
+# are answered from memory first, before paying for an embedding
+EXACT_CACHE_SIZE = 512
+_EXACT_CACHE = OrderedDict()
+_EXACT_CACHE_LOCK = threading.Lock()
+
+def exact_cache_key(user_input: str, chat_history: list, system_prompt: str = None,
+                    model: str = None, temperature: float = None, max_tokens: int = None) -> tuple:
+    """Key for the exact cache: normalized input, full history digest and request settings"""
+    history = hashlib.blake2b(
+        orjson.dumps([(m.type, m.content) for m in chat_history]), digest_size=16
+    ).digest()
+    params = request_params(temperature, max_tokens)
+    return (
+        " ".join(user_input.lower().split()),
+        history,
+        model or current_model,
+        system_prompt or DEFAULT_SYSTEM_PROMPT,
+        round(params["temperature"], 2),
+        params["max_tokens"],
     )
+
+def semantic_cache_key(cache: SemanticCache, user_input: str, chat_history: list, system_prompt: str = None,
+                       model: str = None, temperature: float = None, max_tokens: int = None) -> tuple:
+    """(embedding, scope) key for the semantic cache.
     
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", system_prompt or default_prompt),
-        MessagesPlaceholder(variable_name="history"),
-        ("human", "{input}")
+    The cache is shared by every session, so the scope pins down everything
+    else the answer depends on: request settings and the running summary.
+    """
+    # The previous turn is part of the key, so follow-up questions match only in context
+    summary, turns = split_summary(chat_history)
+    previous = turns[-1].content if turns else ""
+    text = " ".join(f"{previous}\n{user_input}".lower().split())
+    params = request_params(temperature, max_tokens)
+    summary_hash = hashlib.md5("\n".join(m.content for m in summary).encode()).hexdigest() if summary else ""
+    scope = "\n".join([
+        model or current_model,
+        system_prompt or DEFAULT_SYSTEM_PROMPT,
+        f"{round(params['temperature'], 2)}/{params['max_tokens']}",
+        summary_hash,
     ])
+    return cache.embed(text), scope
+
+def cache_lookup(user_input: str, chat_history: list, system_prompt: str = None,
+                 model: str = None, temperature: float = None, max_tokens: int = None):
+    """Look up the prompt in the exact, then the semantic cache; returns (response or None, keys for cache_store)"""
+    exact_key = exact_cache_key(user_input, chat_history, system_prompt, model, temperature, max_tokens)
+    with _EXACT_CACHE_LOCK:
+        if exact_key in _EXACT_CACHE:
+            _EXACT_CACHE.move_to_end(exact_key)
+            return _EXACT_CACHE[exact_key], None
+    
+    cache = get_semantic_cache()
+    if cache is None:
+        return None, (exact_key, None)
+    # A cache problem is never worth failing the request over: fall through to the LLM
+    try:
+        semantic_key = semantic_cache_key(cache, user_input, chat_history, system_prompt, model, temperature, max_tokens)
+        return cache.lookup(*semantic_key), (exact_key, semantic_key)
+    except Exception as e:
+        log.warning("Semantic cache lookup failed: %s", e)
+        return None, (exact_key, None)
+
+def cache_store(keys, response: str):
+    """Save a fresh response under the keys returned by cache_lookup"""
+    if keys is None:
+        return
+    exact_key, semantic_key = keys
+    with _EXACT_CACHE_LOCK:
+        _EXACT_CACHE[exact_key] = response
+        if len(_EXACT_CACHE) > EXACT_CACHE_SIZE:
+            _EXACT_CACHE.popitem(last=False)
+    if semantic_key is not None:
+        try:
+            get_semantic_cache().add(*semantic_key, response)
+        except Exception as e:
+            log.warning("Saving to the semantic cache failed: %s", e)
+
+def build_messages(user_input: str, chat_history: list, system_prompt: str = None) -> list:
+    """Format the prompt messages for a turn; chat_history holds the earlier turns only"""
+    # chat_history starts with the running summary, if any, then the recent turns;
+    # trim_history keeps that start fixed for several turns at a time. It is
+    # already a list of messages, so no prompt template pass is needed.
+    messages = [get_system_message(system_prompt), *chat_history, HumanMessage(content=user_input)]
+    return mark_cache_breakpoints(messages)
+
+# Prompt-caching breakpoint for providers that support it; others ignore the field
+CACHE_CONTROL = {"cache_control": {"type": "ephemeral"}}
+
+def mark_cache_breakpoints(messages: list) -> list:
+    """Mark the system prompt and the end of the earlier turns as cacheable prefixes.
     
-    return prompt
+    The system prompt is the same on every request. The history prefix carries
+    over to the next turn while memory_version is unchanged, i.e. until the
+    next trim step or summary update.
+    """
+    marked = list(messages)
+    # Copies: the history messages are the memory's own objects
+    breakpoints = {0, len(marked) - 2} if len(marked) > 2 else {0}
+    for i in breakpoints:
+        marked[i] = marked[i].copy(update={
+            "additional_kwargs": {**marked[i].additional_kwargs, **CACHE_CONTROL}
+        })
+    return marked
 
-def get_ai_response(
+# Error categories, checked in priority order when a message matches several.
+# Matched against the lowercased message, so the pattern needs no re.I.
+_ERR_RE = re.compile(
+    r"(?P<rate_limit>rate[ _]limit)|(?P<auth>api_key|authentication)|(?P<timeout>timeout)|(?P<model>model|not found)"
+)
+
+def format_error(e: Exception, model: str = None) -> str:
+    """Turn an LLM exception into a helpful message for the chat"""
+    error_str = str(e)
+    found = {m.lastgroup for m in _ERR_RE.finditer(error_str.lower())}
+    
+    # Provide helpful error messages
+    if "rate_limit" in found:
+        return (
+            "⚠️ **Rate Limit Reached**\n\n"
+            "Please wait a moment and try again. Groq has generous free tier limits, "
+            "but they do apply per minute."
+        )
+    elif "auth" in found:
+        return (
+            "⚠️ **API Key Issue**\n\n"
+            "Please check that your GROQ_API_KEY is correctly set in Streamlit secrets."
+        )
+    elif "timeout" in found:
+        return (
+            "⚠️ **Request Timeout**\n\n"
+            "The request took too long. Please try again or select a different model."
+        )
+    elif "model" in found:
+        return (
+            f"⚠️ **Model Error**\n\n"
+            f"The model '{model or current_model}' may not be available. "
+            f"Try selecting a different model from the sidebar."
+        )
+    else:
+        return f"⚠️ **Error**: {error_str}\n\nPlease try again or contact support if the issue persists."
+
+async def get_ai_response(
     user_input: str,
     chat_history: list,
     temperature: float = None,
     max_tokens: int = None,
     system_prompt: str = None,
-    streaming: bool = True,
-    stream_container=None
+    conversation_id: str = None,
+    use_cache: bool = False,
+    model: str = None
 ) -> str:
-    """Generate AI response with conversation history and optional streaming"""
-    global llm
+    """Generate AI response with conversation history.
     
-    if llm is None:
-        raise RuntimeError("LLM not initialized. Please restart the app.")
+    A coroutine: the Groq request is awaited rather than blocking, e.g.
+    run_async(get_ai_response(...)) from the Streamlit script thread.
+    For streaming, use get_ai_response_stream with st.write_stream.
+    """
+    client = resolve_llm(model, temperature, max_tokens)
     
     try:
-        # Update LLM settings if provided
-        if temperature is not None and temperature != current_config.get("temperature"):
-            llm.temperature = temperature
+        cache_key = None
+        if use_cache:
+            # Embedding, index search and file writes are blocking; off the shared
+            # event loop they can't stall other sessions' in-flight requests
+            cached, cache_key = await asyncio.to_thread(
+                cache_lookup, user_input, chat_history, system_prompt, model, temperature, max_tokens
+            )
+            if cached is not None:
+                return cached
         
-        if max_tokens is not None and max_tokens != current_config.get("max_tokens"):
-            llm.max_tokens = max_tokens
+        messages = build_messages(user_input, chat_history, system_prompt)
+        config = run_config(conversation_id, memory_version(chat_history))
+        response = (await client.ainvoke(messages, config=config)).content
         
-        # Get prompt template
-        prompt = get_prompt_template(system_prompt)
+        if cache_key is not None:
+            await asyncio.to_thread(cache_store, cache_key, response)
+        return response
         
-        # Format messages with history
-        messages = prompt.format_messages(
-            history=chat_history[:-1],  # Exclude current user message
-            input=user_input
-        )
+    except Exception as e:
+        return format_error(e, model)
+
+# Streamed text is handed to the UI at most this often (seconds). Every update
+# re-renders the whole response so far, so per-token updates are wasted work.
+STREAM_FLUSH_INTERVAL = 0.05
+
+def throttle_stream(chunks, interval: float = STREAM_FLUSH_INTERVAL):
+    """Coalesce streamed text chunks into at most one piece per `interval`"""
+    buffer = []
+    last_flush = 0.0  # The first chunk goes out immediately
+    try:
+        for chunk in chunks:
+            if not chunk:
+                # e.g. Groq's leading role-only delta; yielding it would hold back the first token
+                continue
+            buffer.append(chunk)
+            now = time.monotonic()
+            if now - last_flush >= interval:
+                yield "".join(buffer)
+                buffer.clear()
+                last_flush = now
+    except Exception:
+        # Hand over what arrived before the error, then let the caller handle it
+        if buffer:
+            yield "".join(buffer)
+        raise
+    if buffer:
+        yield "".join(buffer)
+
+def get_ai_response_stream(
+    user_input: str,
+    chat_history: list,
+    temperature: float = None,
+    max_tokens: int = None,
+    system_prompt: str = None,
+    conversation_id: str = None,
+    use_cache: bool = False,
+    model: str = None
+):
+    """Yield the AI response chunk by chunk as it is generated (for st.write_stream)"""
+    client = resolve_llm(model, temperature, max_tokens)
+    
+    try:
+        cache_key = None
+        if use_cache:
+            cached, cache_key = cache_lookup(user_input, chat_history, system_prompt, model, temperature, max_tokens)
+            if cached is not None:
+                yield cached
+                return
         
-        # Invoke LLM with or without streaming
-        if streaming and stream_container:
-            stream_handler = StreamHandler(stream_container)
-            response = llm.invoke(messages, config={"callbacks": [stream_handler]})
-            return response.content
-        else:
-            response = llm.invoke(messages)
-            return response.content
+        messages = build_messages(user_input, chat_history, system_prompt)
+        config = run_config(conversation_id, memory_version(chat_history))
+        chunks = []
+        for text in throttle_stream(chunk.content for chunk in client.stream(messages, config=config)):
+            chunks.append(text)
+            yield text
         
+        cache_store(cache_key, "".join(chunks))
     except Exception as e:
-        error_str = str(e).lower()
-        
-        # Provide helpful error messages
-        if "rate_limit" in error_str or "rate limit" in error_str:
-            return (
-                "⚠️ **Rate Limit Reached**\n\n"
-                "Please wait a moment and try again. Groq has generous free tier limits, "
-                "but they do apply per minute."
-            )
-        elif "api_key" in error_str or "authentication" in error_str:
-            return (
-                "⚠️ **API Key Issue**\n\n"
-                "Please check that your GROQ_API_KEY is correctly set in Streamlit secrets."
-            )
-        elif "timeout" in error_str:
-            return (
-                "⚠️ **Request Timeout**\n\n"
-                "The request took too long. Please try again or select a different model."
-            )
-        elif "model" in error_str or "not found" in error_str:
-            return (
-                f"⚠️ **Model Error**\n\n"
-                f"The model '{current_config.get('model')}' may not be available. "
-                f"Try selecting a different model from the sidebar."
-            )
-        else:
-            return f"⚠️ **Error**: {str(e)}\n\nPlease try again or contact support if the issue persists."
+        yield format_error(e, model)
 
-def regenerate_response(
+async def regenerate_response(
     user_input: str,
     chat_history: list,
     temperature: float = None,
     max_tokens: int = None,
     system_prompt: str = None,
-    streaming: bool = True,
-    stream_container=None
-) -> str:
-    """Regenerate the last AI response with potentially different parameters"""
-    return get_ai_response(
-        user_input,
-        chat_history,
-        temperature,
-        max_tokens,
-        system_prompt,
-        streaming,
-        stream_container
-    )
+    conversation_id: str = None,
+    model: str = None,
+    n: int = 1
+) -> list:
+    """Regenerate the last AI response; returns up to `n` alternative responses"""
+    # Never served from the response caches: the point is a fresh answer
+    if n <= 1:
+        return [await get_ai_response(
+            user_input,
+            chat_history,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            system_prompt=system_prompt,
+            conversation_id=conversation_id,
+            model=model
+        )]
+    
+    client = resolve_llm(model, temperature, max_tokens)
+    messages = build_messages(user_input, chat_history, system_prompt)
+    config = run_config(conversation_id, memory_version(chat_history))
+    
+    # The n requests run concurrently, so this takes as long as the slowest one, not the sum
+    results = await client.abatch([messages] * n, config=config, return_exceptions=True)
+    responses = [r.content for r in results if not isinstance(r, Exception)]
+    return responses or [format_error(results[0], model)]
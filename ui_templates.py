@@ -0,0 +1,83 @@
+"""
+Static HTML/CSS snippets for the Streamlit UI
+
+Streamlit re-executes app.py on every rerun, so anything built here is
+only computed once per process when the module is first imported.
+"""
+
+# Additional CSS for new features
+EXTRA_CSS = """
+<style>
+.action-button {
+    display: inline-block;
+    padding: 5px 10px;
+    margin: 5px;
+    border-radius: 5px;
+    cursor: pointer;
+    font-size: 12px;
+}
+.copy-btn {
+    background: #4CAF50;
+    color: white;
+}
+.regenerate-btn {
+    background: #2196F3;
+    color: white;
+}
+.export-btn {
+    background: #FF9800;
+    color: white;
+}
+.conversation-item {
+    padding: 10px;
+    margin: 5px 0;
+    border-radius: 8px;
+    cursor: pointer;
+    transition: all 0.3s;
+}
+.conversation-item:hover {
+    background: rgba(102, 126, 234, 0.1);
+}
+</style>
+"""
+
+# Header and welcome screen only depend on the theme, so both variants are built once
+DARK_GRADIENT = "linear-gradient(135deg, #667eea 0%, #764ba2 100%)"
+LIGHT_GRADIENT = "linear-gradient(135deg, #6366f1 0%, #8b5cf6 100%)"
+
+HEADER_TEMPLATE = """
+<div style='text-align: center; padding: 20px 0;'>
+    <h1 style='background: {gradient}; -webkit-background-clip: text; -webkit-text-fill-color: transparent; margin-bottom: 0;'>🤖 ContextIQ</h1>
+    <p style='font-size: 18px; color: #888; margin-top: 5px;'>Your Intelligent AI Assistant with Web Search & Memory</p>
+</div>
+"""
+HEADER_HTML_DARK = HEADER_TEMPLATE.format(gradient=DARK_GRADIENT)
+HEADER_HTML_LIGHT = HEADER_TEMPLATE.format(gradient=LIGHT_GRADIENT)
+
+WELCOME_TEMPLATE = """
+<div style='text-align: center; padding: 60px 20px; background: {gradient}; border-radius: 15px; color: white; margin: 20px 0;'>
+    <h2 style='margin-bottom: 20px;'>👋 Welcome to ContextIQ!</h2>
+    <p style='font-size: 18px; margin-bottom: 30px;'>Your powerful AI assistant with advanced features</p>
+    <div style='display: flex; justify-content: center; gap: 30px; flex-wrap: wrap;'>
+        <div style='text-align: center;'>
+            <div style='font-size: 32px; margin-bottom: 10px;'>💻</div>
+            <div>Coding Help</div>
+        </div>
+        <div style='text-align: center;'>
+            <div style='font-size: 32px; margin-bottom: 10px;'>🔍</div>
+            <div>Web Search</div>
+        </div>
+        <div style='text-align: center;'>
+            <div style='font-size: 32px; margin-bottom: 10px;'>💾</div>
+            <div>Save History</div>
+        </div>
+        <div style='text-align: center;'>
+            <div style='font-size: 32px; margin-bottom: 10px;'>💬</div>
+            <div>Streaming</div>
+        </div>
+    </div>
+    <p style='margin-top: 30px; font-size: 14px; opacity: 0.9;'>Download the User Guide PDF from the sidebar!</p>
+</div>
+"""
+WELCOME_HTML_DARK = WELCOME_TEMPLATE.format(gradient=DARK_GRADIENT)
+WELCOME_HTML_LIGHT = WELCOME_TEMPLATE.format(gradient=LIGHT_GRADIENT)
@@ -1,14 +1,17 @@
 """
 Web search integration using Tavily API
 """
-from langchain_community.tools.tavily_search import TavilySearchResults
-from langchain.agents import AgentExecutor, create_react_agent
 from langchain_core.prompts import PromptTemplate
 import streamlit as st
 
+# The Tavily tool and agent executor are imported on first search rather than
+# at app start-up, so sessions that never search don't pay for them.
+
 def initialize_search_tool():
     """Initialize Tavily search tool"""
     try:
+        from langchain_community.tools.tavily_search import TavilySearchResults
+        
         api_key = st.secrets.get("TAVILY_API_KEY", "")
         if not api_key:
             return None
@@ -27,6 +30,8 @@ def search_web(query: str, llm) -> str:
     Perform web search and return formatted results
     """
     try:
+        from langchain.agents import AgentExecutor, create_react_agent
+        
         search_tool = initialize_search_tool()
         if not search_tool:
             return "⚠️ Web search is not configured. Please add TAVILY_API_KEY to secrets."
@@ -78,14 +83,12 @@ def format_search_results(results: list) -> str:
     if not results:
         return "No results found."
     
-    formatted = "🔍 **Web Search Results:**\n\n"
+    parts = ["🔍 **Web Search Results:**\n\n"]
     for i, result in enumerate(results, 1):
         title = result.get('title', 'No title')
         url = result.get('url', '#')
         snippet = result.get('snippet', 'No description')
         
-        formatted += f"**{i}. {title}**\n"
-        formatted += f"{snippet}\n"
-        formatted += f"🔗 [{url}]({url})\n\n"
+        parts.append(f"**{i}. {title}**\n{snippet}\n🔗 [{url}]({url})\n\n")
     
-    return formatted
+    return "".join(parts)